@@ -1,61 +1,213 @@
 import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
 import shutil
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from collections.abc import Iterable, Iterator
+from contextlib import closing
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pandas as pd
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+import chromadb
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from chromadb.config import Settings
+from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.document_loaders.csv_loader import CSVLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
 from langchain_chroma import Chroma
 from get_embedding_function import get_embedding_function
 
+try:
+    import uvloop  # Faster event loop, not available on Windows
+except ImportError:
+    uvloop = None
+
 
 # CHROMA_PATH = Path('chroma')              # 800 - 80
 # CHROMA_PATH = Path('chroma_1000_150')     # 1000 - 150
 # CHROMA_PATH = Path('chroma_csv')          # 1000 - 150
-CHROMA_PATH = Path('chroma_csv_pdf')
+# CHROMA_PATH = Path('chroma_csv_pdf')      # 1000 - 150
+CHROMA_PATH = Path('chroma_csv_pdf_tok')    # 256 - 40 tokens
 
 PDF_PATH = Path('data/pdf')
 CSV_PATH = Path('data/csv')
 
+# Cell values read as missing, same as the default na_values of pandas.read_csv
+CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+# Modification time and size of the files already ingested. Stored inside the database directory,
+# so that it is removed together with the database.
+MANIFEST_PATH = CHROMA_PATH / 'ingest_manifest.json'
+
+# HNSW index settings, only applied when the collection is created (use --reset to rebuild an existing one).
+# A larger construction_ef and M give a better index at the cost of more memory while building it.
+# batch_size and sync_threshold control how often Chroma updates the index and saves it to disk during inserts.
+# The inserts made since the last save (up to sync_threshold) are replayed from the write-ahead log, and
+# indexed again, by every new process opening the database: with a threshold much larger than the corpus
+# the index would never be saved and every query_data.py run would rebuild it. Keep it well below the
+# number of chunks (a few thousand for the demo corpus).
+COLLECTION_METADATA = {
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:batch_size": 500,
+    "hnsw:sync_threshold": 2000,
+}
+
+# Embeddings already computed, keyed by model and content hash. Kept across database resets.
+EMBEDDING_CACHE_PATH = Path('embedding_cache.sqlite3')
+
+# Upper bound for the number of processes used to parse the PDF and CSV files.
+# The pools are created while the Chroma client, the event loop and its threads are running:
+# workers are spawned rather than forked, since forking a multithreaded process can deadlock.
+MAX_LOADER_WORKERS = 8
+LOADER_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Upper bound for the number of chunks sent to Chroma in a single insert
+MAX_BATCH_SIZE = 250
+
+# Maximum number of IDs looked up in the database with a single query
+MAX_ID_LOOKUP = 1000
+
+# Number of requests sent to the embedding model concurrently for each batch
+MAX_EMBEDDING_REQUESTS = 8
+
 
 def main():
     # Check if the database should be cleared (using the --reset flag)
     parser = argparse.ArgumentParser()
     parser.add_argument("--reset", action="store_true", help="Reset the database.")
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=None,
+        help=f"Number of chunks per Chroma insert, capped to Chroma max batch size (default: {MAX_BATCH_SIZE}).",
+    )
     args = parser.parse_args()
     if args.reset:
         print("Clearing Database")
         clear_database()
 
     # Create (or update) the data store.
-    chunks = load_documents()
-    add_to_chroma(chunks)
+    manifest = load_manifest()
+    chunks = load_documents(manifest)
+    run = uvloop.run if uvloop else asyncio.run
+    run(add_to_chroma(chunks, batch_size=args.batch_size))
+
+    # Only record the files as ingested once their chunks are stored in the database.
+    save_manifest(manifest)
+
+
+def positive_int(value: str):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def load_documents(manifest: dict):
+    """
+    Load PDF and CSV documents from the predefined directories, skipping the files unchanged since the last run.
+    Files are read lazily, so only a few of them are held in memory at any time.
+
+    Returns:
+        Iterator: An iterator over the chunks extracted from the files.
+    """
+    return itertools.chain(pdf_loader(manifest), csv_loader(manifest))
 
 
-def load_documents():
+def load_manifest():
     """
-    Load PDF and CSV documents from the predefined directories.
+    Loads the manifest of the files ingested by the previous runs.
 
     Returns:
-        list: A list containing the chunks extracted from the files.
+        dict: A dictionary mapping each file path to its [modification time (ns), size].
     """
-    pdf_documents = pdf_loader()
-    pdf_chunks = split_documents(pdf_documents)
-    csv_chuncks = csv_loader()
-    return pdf_chunks + csv_chuncks
+    if not MANIFEST_PATH.exists():
+        return {}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
 
+def save_manifest(manifest: dict):
+    # Write to a temporary file first, so that an interrupted run never leaves a truncated manifest.
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
 
-def pdf_loader():
+
+def changed_files(file_paths: list[Path], manifest: dict):
     """
-    Processes a list of PDF files, loads data, and returns the aggregated data.
+    Filters out the files whose modification time and size match the manifest,
+    and records the current state of the remaining ones in the manifest.
 
     Returns:
-        list: A list containing the content of the PDF files.
+        list: A list containing the new or modified files.
     """
-    document_loader = PyPDFDirectoryLoader(str(PDF_PATH))
-    return document_loader.load()
+    changed = []
+    for file_path in file_paths:
+        stat = file_path.stat()
+        state = [stat.st_mtime_ns, stat.st_size]
+        if manifest.get(str(file_path)) != state:
+            manifest[str(file_path)] = state
+            changed.append(file_path)
+
+    print(f"Skipping {len(file_paths) - len(changed)} unchanged files.")
+    return changed
+
+
+def load_pdf(file_path: str) -> list[Document]:
+    """
+    Loads a single PDF file. Defined at module level so that it can be sent to worker processes.
+
+    Returns:
+        list: A list containing one document per page of the PDF file.
+    """
+    return PyPDFLoader(file_path).load()
+
+
+def find_pdf_files(directory: Path):
+    """
+    Finds the PDF files in the directory and its subdirectories, skipping hidden files and directories
+    (e.g. macOS "._file.pdf" metadata files), as PyPDFDirectoryLoader does.
+
+    Returns:
+        list: A sorted list containing the paths of the PDF files.
+    """
+    return sorted(
+        f for f in directory.rglob('*.pdf')
+        if not any(part.startswith('.') for part in f.relative_to(directory).parts)
+    )
+
+
+def pdf_loader(manifest: dict):
+    """
+    Processes a list of PDF files, loads data, and yields the chunks of one file at a time.
+    Files are parsed in parallel, one file per worker process.
+
+    Returns:
+        Iterator: An iterator over the chunks of the PDF files.
+    """
+    file_paths = changed_files(find_pdf_files(PDF_PATH), manifest)
+    max_workers = min(os.cpu_count() or 1, MAX_LOADER_WORKERS)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=LOADER_MP_CONTEXT) as executor:
+        for documents in bounded_map(executor, load_pdf, [str(f) for f in file_paths], window=2 * max_workers):
+            yield from split_documents(documents)
 
 
 def parse_csv_to_list(file_path):
@@ -74,121 +226,286 @@ def parse_csv_to_list(file_path):
     Returns:
         list: A list containing the content of the CSV file. Every entry in the list correspond to a row of the CSV
     """
-    df = pd.read_csv(file_path)
-    formatted_rows = []
-    
-    for index, row in df.iterrows():
-        
-        row_content = []
-        for col in df.columns:
-            cell_content = row[col]
+    # Read every column as text: types inferred from the first block could reject later values,
+    # and the cells are kept exactly as written. Missing values are the same as for pandas.read_csv
+    with closing(pacsv.open_csv(file_path)) as reader:
+        column_names = reader.schema.names
+    table = pacsv.read_csv(
+        file_path,
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in column_names},
+            null_values=CSV_NULL_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+
+    # Format each column at once. Missing cells are found from the arrow null bitmap (which also
+    # covers "NaN" values, parsed as nulls) and set to None; columns without nulls skip the check.
+    formatted_columns = []
+    for col, column in zip(table.column_names, table.columns):
+        values = column.to_pylist()
+        if column.null_count == 0:
+            formatted_columns.append([f"{col}: {v}" for v in values])
+        else:
+            valid = column.is_valid().to_pylist()
+            formatted_columns.append([f"{col}: {v}" if ok else None for v, ok in zip(values, valid)])
+
+    formatted_rows = [
+        Document(
             # Only include cells that are not empty
-            if pd.notna(cell_content):
-                row_content.append(f"{col}: {cell_content}")
-        
-        # Join each column's content with a newline and add to the list
-        document = Document(
-            page_content="\n".join(row_content),
-            metadata={'source': file_path, 'row': index}
+            page_content="\n".join(filter(None, cells)),
+            # Rows have no page number: IDs look like "data/example.csv:None:12"
+            metadata={'source': file_path, 'row': index, 'id': f"{file_path}:None:{index}"}
         )
-        formatted_rows.append(document)
-    
+        for index, cells in enumerate(zip(*formatted_columns))
+    ]
+
     return formatted_rows
 
 
-def csv_loader():
+def csv_loader(manifest: dict):
     """
-    Processes a list of CSV files, loads data, and returns the aggregated data.
+    Processes a list of CSV files, loads data, and yields the rows of one file at a time.
+    Files are parsed in parallel, one file per worker process.
 
     Returns:
-        list: A list containing the aggregated data from all CSV files. Every entry in the list correspond to a row of the CSV
+        Iterator: An iterator over the rows of all CSV files. Every entry correspond to a row of the CSV
     """
-    file_paths = [f for f in CSV_PATH.iterdir() if f.is_file() and f.suffix == '.csv']
-    data = []
+    file_paths = changed_files([f for f in CSV_PATH.iterdir() if f.is_file() and f.suffix == '.csv'], manifest)
     print(f"Loading {len(file_paths)} files.\nFile names: {file_paths}")
+    max_workers = min(os.cpu_count() or 1, MAX_LOADER_WORKERS, max(len(file_paths), 1))
 
-    for file_path in file_paths:
-        file_data = parse_csv_to_list(file_path=str(file_path))  # Ensure loader receives a string path
-        data.extend(file_data)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=LOADER_MP_CONTEXT) as executor:
+        # Ensure loader receives a string path
+        for file_data in bounded_map(executor, parse_csv_to_list, [str(f) for f in file_paths], window=2 * max_workers):
+            print(file_data[0], "\n\n", file_data[-1], "\n\n")
 
-        print(file_data[0], "\n\n", file_data[-1], "\n\n")
+            yield from file_data
 
-    return data
 
+def bounded_map(executor, fn, items, window: int):
+    """
+    Like executor.map, but keeps at most `window` tasks in flight, so that results
+    are not accumulated in memory faster than they are consumed.
 
-def split_documents(documents: list[Document]):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=150,
-        length_function=len,
+    Returns:
+        Iterator: An iterator over the results, in the same order as the items.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def batched(iterable: Iterable, n: int) -> Iterator[list]:
+    """
+    Splits an iterable into lists of n elements (the last one may be shorter).
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+class IndexingSplitter(RecursiveCharacterTextSplitter):
+    """
+    Text splitter that assigns the chunk IDs while splitting, like "data/example.pdf:6:2"
+    [Page Source : Page Number : Chunk Index]
+    """
+
+    def split_documents(self, documents: Iterable[Document]) -> list[Document]:
+        chunks = []
+        for document in documents:
+            page_id = f"{document.metadata.get('source')}:{document.metadata.get('page')}"
+            page_chunks = self.create_documents([document.page_content], [document.metadata])
+
+            # Add the ID to the chunk meta-data.
+            for chunk_index, chunk in enumerate(page_chunks):
+                chunk.metadata["id"] = f"{page_id}:{chunk_index}"
+            chunks.extend(page_chunks)
+
+        return chunks
+
+
+@lru_cache(maxsize=None)
+def get_text_splitter():
+    """
+    Builds the text splitter once and reuses it for every file (loading the tiktoken encoding is not free).
+    Created on first use rather than at import time, so that worker processes do not pay for it.
+    """
+    # Chunk size and overlap are measured in tokens (tiktoken BPE), not characters
+    return IndexingSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base",
+        chunk_size=256,
+        chunk_overlap=40,
         is_separator_regex=False,
     )
-    return text_splitter.split_documents(documents)
 
 
-def add_to_chroma(chunks: list[Document]):
+def split_documents(documents: list[Document]):
+    return get_text_splitter().split_documents(documents)
+
+
+async def add_to_chroma(chunks: Iterable[Document], batch_size: int | None = None):
     # Load the existing database.
+    embedding_function = get_embedding_function()
+    # Persistence is handled by the client itself (SQLite with write-ahead log): every insert is
+    # committed once, no explicit persist() is needed. Telemetry is disabled to skip its per-call overhead.
+    client = chromadb.PersistentClient(path=str(CHROMA_PATH), settings=Settings(anonymized_telemetry=False))
     db = Chroma(
-        persist_directory=str(CHROMA_PATH), embedding_function=get_embedding_function()
+        client=client,
+        embedding_function=embedding_function,
+        collection_metadata=COLLECTION_METADATA,
     )
 
-    # Calculate Page IDs.
-    chunks_with_ids = calculate_chunk_ids(chunks)
+    # Insert in batches: a single call may exceed Chroma's max batch size.
+    batch_size = min(batch_size or MAX_BATCH_SIZE, db._client.get_max_batch_size())
 
     # Add or Update the documents.
-    existing_items = db.get(include=[])  # IDs are always included by default
-    existing_ids = set(existing_items["ids"])
-    print(f"Number of existing documents in DB: {len(existing_ids)}")
-
-    # Only add documents that don't exist in the DB.
-    new_chunks = []
-    for chunk in chunks_with_ids:
-        if chunk.metadata["id"] not in existing_ids:
-            new_chunks.append(chunk)
-
-    if len(new_chunks):
-        print(f"Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
+    print(f"Number of existing documents in DB: {db._collection.count()}")
+
+    loop = asyncio.get_running_loop()
+    batches = batched(chunks, batch_size)
+
+    added = 0
+    pending_insert, pending_count = None, 0
+    with closing(open_embedding_cache()) as cache:
+        # Loading (parsing and splitting the files) and Chroma lookups are blocking: run them in worker
+        # threads, so that the event loop is free while they run.
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            # Only add documents that don't exist in the DB.
+            existing_ids = await asyncio.to_thread(get_existing_ids, db, [chunk.metadata["id"] for chunk in batch])
+            new_chunks = [chunk for chunk in batch if chunk.metadata["id"] not in existing_ids]
+            if not new_chunks:
+                continue
+
+            texts = [chunk.page_content for chunk in new_chunks]
+            embeddings = await embed_texts(embedding_function, texts, cache)
+
+            # Inserts are submitted to a worker thread right away, so each one overlaps with the loading
+            # and embedding of the next batch. Only one insert is in flight at a time.
+            if pending_insert:
+                await pending_insert
+                added += pending_count
+                print(f"Added {added} new documents")
+
+            # Pass precomputed embeddings to the collection, bypassing LangChain's embedding step.
+            pending_insert = loop.run_in_executor(None, partial(
+                db._collection.add,
+                ids=[chunk.metadata["id"] for chunk in new_chunks],
+                documents=texts,
+                metadatas=[chunk.metadata for chunk in new_chunks],
+                embeddings=embeddings,
+            ))
+            pending_count = len(new_chunks)
+
+        if pending_insert:
+            await pending_insert
+            added += pending_count
+            print(f"Added {added} new documents")
+
+    if added:
+        print(f"Total new documents added: {added}")
     else:
         print("No new documents to add")
 
 
-def calculate_chunk_ids(chunks):
+def get_existing_ids(db: Chroma, ids: list[str]):
     """
-    Create chunks IDs like "data/example.pdf:6:2"
-    [Page Source : Page Number : Chunk Index]
+    Looks up which of the given IDs are already stored in the database, without loading
+    all the IDs of the collection. IDs are queried in slices of MAX_ID_LOOKUP.
 
     Returns:
-        list: A list of chunks with their IDs.
+        set: The subset of the IDs that already exist in the database.
     """
-    last_page_id = None
-    current_chunk_index = 0
+    existing_ids = set()
+    for i in range(0, len(ids), MAX_ID_LOOKUP):
+        existing_items = db._collection.get(ids=ids[i:i + MAX_ID_LOOKUP], include=[])  # IDs are always included by default
+        existing_ids.update(existing_items["ids"])
+    return existing_ids
 
-    for chunk in chunks:
-        source = chunk.metadata.get("source")
-        page = chunk.metadata.get("page")
-        current_page_id = f"{source}:{page}"
 
-        # If the page ID is the same as the last one, increment the index.
-        if current_page_id == last_page_id:
-            current_chunk_index += 1
-        else:
-            current_chunk_index = 0
+def open_embedding_cache(path: Path | str = EMBEDDING_CACHE_PATH):
+    cache = sqlite3.connect(str(path))
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))"
+    )
+    return cache
 
-        # Calculate the chunk ID.
-        chunk_id = f"{current_page_id}:{current_chunk_index}"
-        last_page_id = current_page_id
 
-        # Add it to the page meta-data.
-        chunk.metadata["id"] = chunk_id
+async def embed_texts(embedding_function, texts: list[str], cache: sqlite3.Connection):
+    """
+    Computes the embeddings of the texts. Embeddings already stored in the cache are reused,
+    only the missing ones are computed by the embedding function and then added to the cache.
+    Identical texts are embedded only once.
+    Missing embeddings are split into (up to) MAX_EMBEDDING_REQUESTS slices, requested concurrently.
 
-    return chunks
+    Returns:
+        list: A list containing one embedding per text.
+    """
+    model = getattr(embedding_function, "model", "")
+    hashes = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+
+    # One embedding per distinct text: duplicated chunks (headers, footers, ...) share it.
+    embeddings = {}
+    for text_hash in set(hashes):
+        row = cache.execute(
+            "SELECT vector FROM embeddings WHERE model = ? AND hash = ?", (model, text_hash)
+        ).fetchone()
+        if row:
+            embeddings[text_hash] = list(array('d', row[0]))
+
+    missing = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in embeddings}
+    if missing:
+        missing_texts = list(missing.values())
+        # Spread the texts evenly over the requests (at least one text each), in order
+        n_slices = min(len(missing_texts), MAX_EMBEDDING_REQUESTS)
+        bounds = [len(missing_texts) * k // n_slices for k in range(n_slices + 1)]
+        text_slices = [missing_texts[bounds[k]:bounds[k + 1]] for k in range(n_slices)]
+
+        # Embedding requests are I/O bound (HTTP calls to Ollama): overlap them on the event loop.
+        new_embeddings = list(itertools.chain.from_iterable(
+            await asyncio.gather(*(embedding_function.aembed_documents(text_slice) for text_slice in text_slices))
+        ))
+        for text_hash, embedding in zip(missing, new_embeddings):
+            embeddings[text_hash] = embedding
+            cache.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                (model, text_hash, array('d', embedding).tobytes()),
+            )
+        cache.commit()
+
+    return [embeddings[text_hash] for text_hash in hashes]
 
 
 def clear_database():
+    """
+    Moves the database directory out of the way (a rename is atomic and immediate) and deletes it
+    in a background thread, so that the new database can be populated in the meantime.
+    The thread is not a daemon: the interpreter waits for the deletion to complete before exiting.
+    Leftovers of interrupted deletions are removed as well.
+
+    Returns:
+        Thread: The thread deleting the old directories, or None if there is nothing to delete.
+    """
+    trash_paths = list(CHROMA_PATH.parent.glob(f".trash-{CHROMA_PATH.name}-*"))
     if os.path.exists(str(CHROMA_PATH)):
-        shutil.rmtree(str(CHROMA_PATH))
+        trash_path = CHROMA_PATH.with_name(f".trash-{CHROMA_PATH.name}-{os.getpid()}-{time.time_ns()}")
+        CHROMA_PATH.rename(trash_path)
+        trash_paths.append(trash_path)
+
+    if not trash_paths:
+        return None
+    deletion = threading.Thread(target=remove_directories, args=(trash_paths,))
+    deletion.start()
+    return deletion
+
+
+def remove_directories(paths: list[Path]):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -7,7 +7,8 @@ from get_embedding_function import get_embedding_function
 #CHROMA_PATH = "chroma"
 #CHROMA_PATH = "chroma_1000_150"
 #CHROMA_PATH = "chroma_csv"
-CHROMA_PATH = "chroma_csv_pdf"
+#CHROMA_PATH = "chroma_csv_pdf"
+CHROMA_PATH = "chroma_csv_pdf_tok"
 
 PROMPT_TEMPLATE = """
 Answer the question based only on the following context:
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import pytest
+from langchain.schema.document import Document
+import populate_database
+from populate_database import (
+    MAX_EMBEDDING_REQUESTS,
+    IndexingSplitter,
+    batched,
+    bounded_map,
+    changed_files,
+    clear_database,
+    embed_texts,
+    find_pdf_files,
+    load_manifest,
+    open_embedding_cache,
+    parse_csv_to_list,
+    positive_int,
+    save_manifest,
+)
+
+
+def test_positive_int():
+    assert positive_int("5") == 5
+    for value in ["0", "-3", "abc"]:
+        with pytest.raises((argparse.ArgumentTypeError, ValueError)):
+            positive_int(value)
+
+
+def test_find_pdf_files_skips_hidden(tmp_path):
+    for name in ["b.pdf", "a.pdf", "sub/c.pdf", "._a.pdf", ".git/d.pdf", "sub/.hidden/e.pdf", "notes.txt"]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b"")
+
+    assert find_pdf_files(tmp_path) == [tmp_path / "a.pdf", tmp_path / "b.pdf", tmp_path / "sub" / "c.pdf"]
+
+
+def test_indexing_splitter_ids_restart_per_page():
+    splitter = IndexingSplitter(chunk_size=10, chunk_overlap=0)
+    documents = [
+        Document(page_content="aaaa bbbb cccc dddd", metadata={"source": "data/pdf/a.pdf", "page": 0}),
+        Document(page_content="eeee ffff gggg", metadata={"source": "data/pdf/a.pdf", "page": 1}),
+    ]
+
+    chunks = splitter.split_documents(documents)
+
+    assert [chunk.metadata["id"] for chunk in chunks] == [
+        "data/pdf/a.pdf:0:0",
+        "data/pdf/a.pdf:0:1",
+        "data/pdf/a.pdf:1:0",
+        "data/pdf/a.pdf:1:1",
+    ]
+    # The original metadata is kept on every chunk
+    assert all(chunk.metadata["source"] == "data/pdf/a.pdf" for chunk in chunks)
+
+
+def test_csv_rows_ids(tmp_path):
+    file_path = str(tmp_path / "example.csv")
+    with open(file_path, "w") as f:
+        f.write("name,value\nfoo,1\nbar,2\n")
+
+    rows = parse_csv_to_list(file_path)
+
+    assert [row.metadata["id"] for row in rows] == [f"{file_path}:None:0", f"{file_path}:None:1"]
+    assert [row.metadata["row"] for row in rows] == [0, 1]
+
+
+def test_csv_cells_are_kept_as_written(tmp_path):
+    file_path = str(tmp_path / "example.csv")
+    with open(file_path, "w") as f:
+        f.write("code,price\n007,1.50\nA12,unknown\n")
+
+    rows = parse_csv_to_list(file_path)
+
+    assert [row.page_content for row in rows] == ["code: 007\nprice: 1.50", "code: A12\nprice: unknown"]
+
+
+def test_csv_missing_cells_are_dropped(tmp_path):
+    file_path = str(tmp_path / "example.csv")
+    with open(file_path, "w") as f:
+        f.write("a,b,c\n1,,x\nNaN,2,\n")
+
+    rows = parse_csv_to_list(file_path)
+
+    assert [row.page_content for row in rows] == ["a: 1\nc: x", "b: 2"]
+
+
+def test_csv_pandas_missing_values_are_dropped(tmp_path):
+    file_path = str(tmp_path / "example.csv")
+    with open(file_path, "w") as f:
+        f.write("a,b,c\nNone,<NA>,x\n")
+
+    rows = parse_csv_to_list(file_path)
+
+    assert [row.page_content for row in rows] == ["c: x"]
+
+
+def test_changed_files(tmp_path):
+    file_path = tmp_path / "example.csv"
+    file_path.write_text("a\n1\n")
+    manifest = {}
+
+    assert changed_files([file_path], manifest) == [file_path]
+    assert changed_files([file_path], manifest) == []
+
+    file_path.write_text("a\n1\n2\n")
+    os.utime(file_path, ns=(0, 0))
+    assert changed_files([file_path], manifest) == [file_path]
+
+
+def test_manifest_round_trip(tmp_path, monkeypatch):
+    manifest_path = tmp_path / "chroma" / "ingest_manifest.json"
+    monkeypatch.setattr(populate_database, "MANIFEST_PATH", manifest_path)
+
+    assert load_manifest() == {}
+
+    manifest = {"data/pdf/a.pdf": [1700000000000000000, 1024]}
+    save_manifest(manifest)
+
+    assert load_manifest() == manifest
+    assert list(manifest_path.parent.iterdir()) == [manifest_path]
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_bounded_map_keeps_order():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(bounded_map(executor, lambda x: x * x, range(10), window=3)) == [x * x for x in range(10)]
+
+
+class FakeEmbeddings:
+    """
+    Embedding function that records the texts it receives and how many requests run at the same time.
+    """
+
+    model = "fake"
+
+    def __init__(self):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def aembed_documents(self, texts):
+        self.requests.append(texts)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_embed_texts_reuses_cached_embeddings():
+    embedding_function = FakeEmbeddings()
+
+    with closing(open_embedding_cache(":memory:")) as cache:
+        first = asyncio.run(embed_texts(embedding_function, ["a", "bb"], cache))
+        second = asyncio.run(embed_texts(embedding_function, ["bb", "ccc"], cache))
+
+        # The cache is keyed by model: another model computes its own embeddings
+        other_model = FakeEmbeddings()
+        other_model.model = "other"
+        asyncio.run(embed_texts(other_model, ["a"], cache))
+
+    assert first == [[1.0, 1.0], [2.0, 1.0]]
+    assert second == [[2.0, 1.0], [3.0, 1.0]]
+    # Only "ccc" was missing from the cache on the second call
+    assert sorted(text for request in embedding_function.requests for text in request) == ["a", "bb", "ccc"]
+    assert other_model.requests == [["a"]]
+
+
+def test_embed_texts_embeds_duplicates_once():
+    embedding_function = FakeEmbeddings()
+
+    with closing(open_embedding_cache(":memory:")) as cache:
+        embeddings = asyncio.run(embed_texts(embedding_function, ["header", "body", "header"], cache))
+
+    assert embeddings == [[6.0, 1.0], [4.0, 1.0], [6.0, 1.0]]
+    assert sorted(text for request in embedding_function.requests for text in request) == ["body", "header"]
+
+
+def test_embed_texts_requests_overlap():
+    embedding_function = FakeEmbeddings()
+    texts = [f"text {i}" for i in range(20)]
+
+    with closing(open_embedding_cache(":memory:")) as cache:
+        embeddings = asyncio.run(embed_texts(embedding_function, texts, cache))
+
+    assert embeddings == [[float(len(text)), 1.0] for text in texts]
+    assert len(embedding_function.requests) == MAX_EMBEDDING_REQUESTS
+    assert embedding_function.max_in_flight == MAX_EMBEDDING_REQUESTS
+
+
+def test_clear_database_removes_database_and_old_trash(tmp_path, monkeypatch):
+    chroma_path = tmp_path / "chroma"
+    (chroma_path / "index").mkdir(parents=True)
+    # Left behind by an interrupted reset
+    (tmp_path / ".trash-chroma-123-456" / "index").mkdir(parents=True)
+    # Trash of another database, not touched
+    other_trash = tmp_path / ".trash-chroma_other-123-456"
+    other_trash.mkdir()
+    monkeypatch.setattr(populate_database, "CHROMA_PATH", chroma_path)
+
+    deletion = clear_database()
+
+    # The database is moved away immediately, and deleted in the background
+    assert not chroma_path.exists()
+    deletion.join()
+    assert list(tmp_path.iterdir()) == [other_trash]